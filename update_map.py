@@ -1,23 +1,41 @@
 import arxiv
+import argparse
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import subprocess
+import csv
 import os
 import re
+import sys
 import json
+import random
 import time
 import shutil
+import zipfile
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
 DB_PATH = "database.parquet"
+ATLAS_INPUT_PATH = "atlas_input.parquet"
 LABELS_PATH = "manual_labels.csv"
 STOPWORDS_PATH = "stop_words.csv"
+WINDOW_DAYS = 7
+MAX_RESULTS = 200
+MAX_ROWS = 1000
+EMBED_MODEL = "allenai/specter2_base"
+EMBED_BATCH_SIZE = 32
+
+INSTITUTIONS = ("MIT", "Stanford", "CMU", "Berkeley", "Harvard", "DeepMind", "OpenAI", "Anthropic", "FAIR", "Meta")
+INSTITUTION_PATTERN = re.compile(r"\b(?:" + "|".join(map(re.escape, INSTITUTIONS)) + r")\b", re.I)
 
 # --- 1. DATA PREP ---
 def load_stop_words():
+    # A one-column CSV doesn't need pandas' parser
     if os.path.exists(STOPWORDS_PATH):
-        sw_df = pd.read_csv(STOPWORDS_PATH)
-        return set(sw_df['word'].str.lower().tolist())
-    return set()
+        with open(STOPWORDS_PATH, newline="") as f:
+            return frozenset(row['word'].lower() for row in csv.DictReader(f) if row['word'])
+    return frozenset()
 
 STOP_WORDS = load_stop_words()
 
@@ -26,49 +44,143 @@ def scrub_text(text):
     cleaned = [w for w in words if w.lower().strip('.,()[]{}') not in STOP_WORDS]
     return " ".join(cleaned)
 
-def fetch_results_with_retry(client, search):
-    for i in range(5):
+# Reputation logic (strictly for coloring)
+def calculate_reputation(df):
+    # One vectorized pass per signal instead of a Python call per row
+    # Object dtype keeps Python's re semantics; pandas 3's pyarrow strings would run the pattern on RE2 (ASCII-only \b)
+    title, summary = df['title'].astype(object), df['summary'].astype(object)
+    # Names never contain spaces, so matching title and summary separately equals matching them joined
+    inst = title.str.contains(INSTITUTION_PATTERN) | summary.str.contains(INSTITUTION_PATTERN)
+    # A code link alone (+2) can't reach the threshold, so only institution hits need the second scan
+    code = pd.Series(False, index=df.index)
+    code[inst] = summary[inst].str.lower().str.contains("github.com", regex=False)
+    score = inst.astype('int8') * 3 + code.astype('int8') * 2
+    return np.where(score >= 4, "Enhanced", "Standard")
+
+def embed_texts(texts):
+    # Heavy imports live here so runs with nothing new to embed never load torch
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    # SPECTER2 paper embedding = the [CLS] vector of the last hidden state
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL)
+    model = AutoModel.from_pretrained(EMBED_MODEL).to(device).eval()
+    if device == "cuda":
+        model = model.half()
+    else:
+        # int8 weights for the Linear layers roughly halve CPU inference time
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    # Batch texts of similar length together so little compute goes to padding, then restore input order
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    vectors = [None] * len(texts)
+    with torch.inference_mode():
+        for start in range(0, len(order), EMBED_BATCH_SIZE):
+            idx = order[start:start + EMBED_BATCH_SIZE]
+            batch = tokenizer([texts[i] for i in idx], padding="longest", truncation=True, max_length=512, return_tensors="pt").to(device)
+            for i, vec in zip(idx, model(**batch).last_hidden_state[:, 0, :].float().cpu().numpy()):
+                vectors[i] = vec
+    return vectors
+
+def quantize_vectors(vectors):
+    # Symmetric per-vector int8: a quarter of the float32 bytes in the committed database
+    scales = [float(np.abs(v).max()) / 127 or 1.0 for v in vectors]
+    return [np.round(v / s).astype(np.int8) for v, s in zip(vectors, scales)], scales
+
+def load_database(cutoff):
+    # The previous run's parquet doubles as a cache keyed by arXiv id
+    # Databases written before the 'date' column existed can't be aged out, so start fresh
+    if os.path.exists(DB_PATH) and 'date' in pq.read_schema(DB_PATH).names:
+        # The date filter is pushed into the parquet reader, so expired rows are never materialized
+        return pd.read_parquet(DB_PATH, filters=[('date', '>=', cutoff)])
+    return None
+
+def fetch_results_with_retry(client, search, attempts=5):
+    for i in range(attempts):
         try:
             return list(client.results(search))
         except Exception as e:
-            time.sleep((2**i) * 30)
+            if i == attempts - 1: break
+            # Capped exponential backoff with jitter; arxiv's HTTPError carries no Retry-After to honor
+            wait = min(300, (2**i) * 30) + random.uniform(0, 5)
+            print(f"⚠️ arXiv fetch failed ({e}), retrying in {wait:.0f}s...")
+            time.sleep(wait)
     return []
 
 if __name__ == "__main__":
-    if os.path.exists("docs"): shutil.rmtree("docs")
-    os.makedirs("docs")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force", action="store_true", help="Rebuild the map even if no new papers arrived")
+    args = parser.parse_args()
 
-    client = arxiv.Client(page_size=100, delay_seconds=5)
+    # One page covers the whole window, so the client never sleeps between requests
+    client = arxiv.Client(page_size=MAX_RESULTS, delay_seconds=5)
     now = datetime.now(timezone.utc)
+    # Snap to a 10-minute grid so reruns close together send the identical query
+    now = now.replace(minute=now.minute // 10 * 10, second=0, microsecond=0)
+    cutoff = now - timedelta(days=WINDOW_DAYS)
     search = arxiv.Search(
-        query=f"cat:cs.AI AND submittedDate:[{(now-timedelta(days=7)).strftime('%Y%m%d%H%M')} TO {now.strftime('%Y%m%d%H%M')}]", 
-        max_results=200
+        query=f"cat:cs.AI AND submittedDate:[{cutoff.strftime('%Y%m%d%H%M')} TO {now.strftime('%Y%m%d%H%M')}]", 
+        max_results=MAX_RESULTS
     )
+    cached = load_database(cutoff)
     
     results = fetch_results_with_retry(client, search)
-    if results:
-        data = []
-        for r in results:
-            # We preserve title/abstract for the user but scrub the 'text' column used for the AI
-            data.append({
-                "title": r.title,
-                "summary": r.summary,
-                "text": scrub_text(f"{r.title} {r.summary}"),
-                "url": r.pdf_url,
-                "id": r.entry_id.split('/')[-1]
-            })
-            
-        df = pd.DataFrame(data)
-        
-        # Reputation logic (strictly for coloring)
-        inst_pat = re.compile(r"\b(MIT|Stanford|CMU|Berkeley|Harvard|DeepMind|OpenAI|Anthropic|FAIR|Meta)\b", re.I)
-        def get_rep(row):
-            score = 3 if inst_pat.search(f"{row['title']} {row['summary']}") else 0
-            if 'github.com' in row['summary'].lower(): score += 2
-            return "Enhanced" if score >= 4 else "Standard"
-        
-        df['Reputation'] = df.apply(get_rep, axis=1)
-        df.to_parquet(DB_PATH, index=False)
+    # Columns are filled directly so pandas doesn't have to transpose a list of row dicts
+    cols = {k: [] for k in ("title", "summary", "text", "url", "id", "date")}
+    seen = set(cached['id']) if cached is not None else set()
+    for r in results:
+        paper_id = r.entry_id.rpartition('/')[2]
+        if paper_id in seen: continue # Already cached, or a duplicate entry in this response
+        seen.add(paper_id)
+        # We preserve title/abstract for the user but scrub the 'text' column used for the AI
+        cols["title"].append(r.title)
+        cols["summary"].append(r.summary)
+        cols["text"].append(scrub_text(f"{r.title} {r.summary}"))
+        cols["url"].append(r.pdf_url)
+        cols["id"].append(paper_id)
+        cols["date"].append(r.published)
+
+    df = pd.DataFrame(cols)
+
+    # With nothing new, still rebuild if papers aged out of the window since the last write, on --force,
+    # or when there is no site to keep (docs/ isn't committed, so a fresh checkout never has one)
+    site_missing = not os.path.exists("docs/index.html")
+    stale = cached is not None and (args.force or site_missing or len(cached) < pq.read_metadata(DB_PATH).num_rows)
+    if df.empty and not stale:
+        if cached is None and (args.force or site_missing):
+            print("⚠️ No new papers and no cached database to rebuild the map from.")
+        else:
+            print("💤 No new papers since the last build, keeping the existing map.")
+    else:
+        if df.empty:
+            df = cached
+        else:
+            # Only the new papers need scoring; cached rows keep their Reputation
+            df['Reputation'] = calculate_reputation(df)
+            df = pd.concat([cached, df], ignore_index=True)
+            # A revised abstract arrives under a new versioned id (e.g. ...v2); keep only the latest version
+            df = df[~df['id'].str.replace(r'v\d+$', '', regex=True).duplicated(keep='last')]
+        # Keep the map bounded as the rolling cache grows: newest MAX_ROWS papers only
+        df = df.sort_values('date').tail(MAX_ROWS).reset_index(drop=True)
+        if df.empty:
+            # Everything cached expired and nothing new arrived (e.g. an arXiv outage): don't publish an empty map
+            print("⚠️ No papers left in the window, keeping the existing database and map.")
+            sys.exit(0)
+
+        # Embeddings are cached in the database too (int8 + scale); only rows without one hit SPECTER2
+        if 'vector_scale' not in df.columns: df['vector_scale'] = np.nan
+        missing = df['vector_scale'].isna()
+        if missing.any():
+            print(f"🔢 Embedding {missing.sum()} new papers...")
+            vectors, scales = quantize_vectors(embed_texts(df.loc[missing, 'text'].tolist()))
+            df.loc[missing, 'vector'] = pd.Series(vectors, index=df.index[missing], dtype=object)
+            df.loc[missing, 'vector_scale'] = scales
+        df.to_parquet(DB_PATH, index=False, compression="zstd", compression_level=3)
+
+        # embedding-atlas gets plain float32 vectors; the scale column is a storage detail
+        atlas_df = df.drop(columns='vector_scale')
+        atlas_df['vector'] = [q.astype(np.float32) * s for q, s in zip(df['vector'], df['vector_scale'])]
+        atlas_df.to_parquet(ATLAS_INPUT_PATH, index=False)
 
         # --- THE BRUTE FORCE LABEL FIX ---
         # We tell the tool: "Don't guess. Here is the label for the center of the map."
@@ -80,25 +192,35 @@ if __name__ == "__main__":
 
         print("🧠 Building Map with Manual Labels...")
         subprocess.run([
-            "embedding-atlas", DB_PATH, 
+            "embedding-atlas", ATLAS_INPUT_PATH, 
             "--text", "text", 
+            "--vector", "vector", # <--- PRECOMPUTED SPECTER2 EMBEDDINGS
             "--labels", LABELS_PATH, # <--- FORCING THE LABEL
-            "--model", "allenai/specter2_base", 
             "--export-application", "site.zip"
         ], check=True)
         
-        os.system("unzip -o site.zip -d docs/ && touch docs/.nojekyll")
+        # Stage the new site beside the live one so docs/ is never half-written
+        if os.path.exists("docs.new"): shutil.rmtree("docs.new")
+        with zipfile.ZipFile("site.zip") as z: z.extractall("docs.new")
+        Path("docs.new/.nojekyll").touch()
         
         # --- UI CONFIG ---
-        config_path = "docs/data/config.json"
+        config_path = "docs.new/data/config.json"
         if os.path.exists(config_path):
-            with open(config_path, "r") as f: conf = json.load(f)
-            conf["name_column"] = "title"
-            conf.update({
-                "color_by": "Reputation",
-                "topic_label_column": None, # Disable the tool's broken auto-labels
-                "column_mappings": {"title":"title", "Reputation":"Reputation", "url":"url"}
-            })
-            with open(config_path, "w") as f: json.dump(conf, f, indent=4)
+            # Edit in place through one handle: read, rewind, rewrite, cut off any leftover tail
+            with open(config_path, "r+") as f:
+                conf = json.load(f)
+                conf["name_column"] = "title"
+                conf.update({
+                    "color_by": "Reputation",
+                    "topic_label_column": None, # Disable the tool's broken auto-labels
+                    "column_mappings": {"title":"title", "Reputation":"Reputation", "url":"url"}
+                })
+                f.seek(0)
+                json.dump(conf, f, indent=4)
+                f.truncate()
+
+        if os.path.exists("docs"): shutil.rmtree("docs")
+        os.replace("docs.new", "docs")
 
         print("✨ Deployment Successful!")